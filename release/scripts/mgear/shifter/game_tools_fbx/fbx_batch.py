@@ -24,18 +24,56 @@ Tasks / Conditions
 Note
 ----
 - Print logs are being used by the partition subprocess thread to detect progress.
+- Logs from the per partition / per object loops are buffered with _log, and written
+  to stdout in one go by _flush_log.
 """
+import io
+import json
 import os
+import shutil
+import subprocess
+import sys
+import tempfile
 import traceback
 from collections import OrderedDict
 
 import maya.cmds as cmds
 import maya.api.OpenMaya as om
+import maya.api.OpenMayaAnim as oma
 import pymel.core as pm
 
+import mgear
 from mgear.core import pyFBX as pfbx
+from mgear.core import utils as coreUtils
 import mgear.shifter.game_tools_disconnect as gtDisc
 
+# Buffers the logs of the hot loops, as each print is flushed through the
+# MayaBatch output.
+_log_buf = io.StringIO()
+
+
+def _log(msg):
+    """
+    Adds the message to the log buffer.
+
+    :param str msg: message to log.
+    """
+    _log_buf.write(msg)
+    _log_buf.write("\n")
+
+
+def _flush_log():
+    """
+    Writes the buffered logs to stdout in one go, and clears the buffer.
+    """
+    logs = _log_buf.getvalue()
+    if logs:
+        sys.stdout.write(logs)
+        sys.stdout.flush()
+    _log_buf.seek(0)
+    _log_buf.truncate()
+
+
 def perform_fbx_condition(
         remove_namespace,
         scene_clean,
@@ -76,9 +114,8 @@ def perform_fbx_condition(
         export_data = _clean_namespaces(export_data)
 
         # updates root joint name if namespace is found
-        root_joint = root_joint.split(":")[-1]
-        for i in range(len(root_geos)):
-            root_geos[i] = root_geos[i].split(":")[-1]
+        root_joint = root_joint.rsplit(":", 1)[-1]
+        root_geos = [geo.rsplit(":", 1)[-1] for geo in root_geos]
 
     if scene_clean:
         print("Cleaning Scene..")
@@ -133,67 +170,89 @@ def perform_fbx_condition(
     # Save out conditioned file, as this will be used by other partition processes
     # Conditioned file, is the file that stores the rig which has already had data
     # update for the export process.
-    print("Save Conditioned Scene...")
-    print("    Path: {}".format(master_ma_path))
-    cmds.file(save=True, force=True, type="mayaAscii")
-
+    # It is written to the temporary directory, as it is read again by every partition.
+    work_dir = None
     status = False
 
-    if not partitions:
-        # Exports the conditioned FBX
-        master_fbx_path = os.path.join(output_dir, fbx_file)
-        print("Exporting FBX...")
-        print("    Path: {}".format(master_fbx_path))
-        cmds.select(clear=True)
-        cmds.select([root_joint] + root_geos)
-        pfbx.FBXExport(f=master_fbx_path, s=True)
-        status = True
-
-    if partitions and export_data is not None:
-        print("[Partitions]")
-        print("   Preparing scene for Partition creation..")
-        status = _export_skeletal_mesh_partitions([root_joint], export_data, master_ma_path)
-
-    # Delete temporary conditioned .ma file
-    print("[Clean up]")
-    cmds.file(new=True, force=True)
-    if os.path.exists(master_ma_path):
-        print("   [Removing File] {}".format(master_ma_path))
-        os.remove(master_ma_path)
-    else:
-        print("   Cleaned up conditioned file...")
-        print("      Deleted - {}".format(master_ma_path))
-
+    try:
+        work_dir = tempfile.mkdtemp(prefix="mgear_fbx_", dir=_get_tmp_root())
+        conditioned_file = os.path.join(work_dir, os.path.basename(master_ma_path))
+        print("Save Conditioned Scene...")
+        print("    Path: {}".format(conditioned_file))
+        cmds.file(rename=conditioned_file)
+        cmds.file(save=True, force=True, type="mayaAscii")
+
+        if not partitions:
+            # Exports the conditioned FBX
+            master_fbx_path = os.path.join(output_dir, fbx_file)
+            print("Exporting FBX...")
+            print("    Path: {}".format(master_fbx_path))
+            cmds.select(clear=True)
+            cmds.select([root_joint] + root_geos)
+            pfbx.FBXExport(f=master_fbx_path, s=True)
+            status = True
+
+        if partitions and export_data is not None:
+            print("[Partitions]")
+            print("   Preparing scene for Partition creation..")
+            status = _export_skeletal_mesh_partitions(
+                [root_joint], export_data, conditioned_file, staging_dir=work_dir)
+    finally:
+        # Delete temporary master and conditioned .ma files, even if the export failed
+        print("[Clean up]")
+        cmds.file(new=True, force=True)
+        if os.path.exists(master_ma_path):
+            print("   [Removing File] {}".format(master_ma_path))
+            os.remove(master_ma_path)
+        if work_dir is not None and os.path.exists(work_dir):
+            print("   [Removing Directory] {}".format(work_dir))
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    _flush_log()
     return status
 
 
-def _export_skeletal_mesh_partitions(jnt_roots, export_data, scene_path):
+def _export_skeletal_mesh_partitions(jnt_roots, export_data, scene_path, staging_dir=None):
     """
     Exports the individual partition hierarchies that have been specified.
 
     For each Partition, the conditioned .ma file will be loaded and have 
-    alterations performed to it.
+    alterations performed to it. When there is more than one partition, the
+    partitions are split across multiple mayapy worker processes.
+
+    If a staging directory is given, the partition fbx files are exported there
+    and then moved to the export file path.
 
     """
     print("   Correlating Mesh to joints...")
 
-    file_path = export_data.get("file_path", "")
-    file_name = export_data.get("file_name", "")
-
     partitions = export_data.get("partitions", dict())
     if not partitions:
         cmds.warning("  Partitions not defined!")
         return False
 
-    cull_joints = export_data.get("cull_joints", False)
-
     # Collects all partition data, so it can be more easily accessed in the next stage
     # where mesh and skeleton data is deleted and exported.
 
     partitions_data = OrderedDict()
+
+    # Root to joint paths, shared by all partitions as the scene does not
+    # change while the partitions are correlated.
+    ancestor_caches = dict()
+
+    # Queries the skin influences once per mesh, as meshes can be shared by partitions.
+    all_meshes = set()
+    for data in partitions.values():
+        if data.get("enabled", False):
+            all_meshes.update(data.get("skeletal_meshes", None) or [])
+    mesh_influences = {
+        mesh: cmds.skinCluster(mesh, query=True, influence=True) or []
+        for mesh in all_meshes
+    }
+
     for partition_name, data in partitions.items():
 
-        print("     Partition: {} \t Data: {}".format(partition_name, data))
+        _log("     Partition: {} \t Data: {}".format(partition_name, data))
 
         # Skip partition if disabled
         enabled = data.get("enabled", False)
@@ -203,18 +262,23 @@ def _export_skeletal_mesh_partitions(jnt_roots, export_data, scene_path):
         meshes = data.get("skeletal_meshes", None)
 
         joint_hierarchy = OrderedDict()
+        # Mirrors joint_hierarchy as sets, for fast membership checks.
+        joint_hierarchy_seen = dict()
         for mesh in meshes:
             # we retrieve all end joints from the influenced joints
-            influences = cmds.skinCluster(mesh, query=True, influence=True)
+            influences = mesh_influences[mesh]
 
             # Gets hierarchy from the root joint to the influence joints.
             for jnt_root in jnt_roots:
                 joint_hierarchy.setdefault(jnt_root, list())
+                seen = joint_hierarchy_seen.setdefault(jnt_root, set())
 
                 for inf_jnt in influences:
-                    jnt_hierarchy = _get_joint_list(jnt_root, inf_jnt)
+                    jnt_hierarchy = _get_cached_joint_list(
+                        jnt_root, inf_jnt, ancestor_caches.setdefault(jnt_root, dict()))
                     for hierarchy_jnt in jnt_hierarchy:
-                        if hierarchy_jnt not in joint_hierarchy[jnt_root]:
+                        if hierarchy_jnt not in seen:
+                            seen.add(hierarchy_jnt)
                             joint_hierarchy[jnt_root].append(hierarchy_jnt)
 
         partitions_data.setdefault(partition_name, dict())
@@ -243,80 +307,542 @@ def _export_skeletal_mesh_partitions(jnt_roots, export_data, scene_path):
 
         partitions_data[partition_name]["hierarchy"] = short_hierarchy
 
+    # Writes the correlation logs before the next stages print.
+    _flush_log()
+
     print("   Modifying Hierarchy...")
 
-    # - Loop over each Partition
-    # - Load the master .ma file
-    # - Perform removal of geometry, that is not relevent to the partition
-    # - Perform removal of skeleton, that is not relevent to the partition
-    # - Export an fbx
+    # Collects the partitions that have data to export, each job is the
+    # partition name, its correlated data and the meshes to keep.
+    partition_jobs = []
     for partition_name, partition_data in partitions_data.items():
         if not partition_data:
-            print("   Partition {} contains no data.".format(partition_name))
+            _log("   Partition {} contains no data.".format(partition_name))
             continue
 
         partition_meshes = partitions.get(partition_name).get("skeletal_meshes")
-        partition_joints = partition_data.get("hierarchy", [])
-
-        print("Open Conditioned Scene: {}".format(scene_path))
-        # Loads the conditioned scene file, to perform partition actions on.
-        cmds.file(scene_path, open=True, force=True, save=False)
-
-        # Deletes meshes that are not included in the partition.
-        all_meshes = _get_all_mesh_dag_objects()
-        for mesh in all_meshes:
-            if not mesh in partition_meshes:
-                cmds.delete(mesh)
-
-        # Delete joints that are not included in the partition
-        if cull_joints:
-            print("    Culling Joints...")
-            all_joints = _get_all_joint_dag_objects()
-            for jnt in reversed(all_joints):
-                if not jnt in partition_joints:
-                    cmds.delete(jnt)
-
-        # Exporting fbx
-        partition_file_name = file_name + "_" + partition_name + ".fbx"
-        export_path = os.path.join(file_path, partition_file_name)
-
-        print("Exporting FBX: {}".format(export_path))
+        partition_jobs.append((partition_name, partition_data, partition_meshes))
+
+    # Makes sure the correlation logs are written, before the workers start logging.
+    _flush_log()
+
+    if not partition_jobs:
+        return True
+
+    file_path = export_data.get("file_path", "")
+    if staging_dir is not None:
+        export_data = dict(export_data)
+        export_data["file_path"] = staging_dir
+
+    # When the partitions split the scene without overlapping, each partition
+    # can be exported by selection alone, without deleting the rest of the scene.
+    select_only = _is_disjoint_scene_cover(
+        partition_jobs, export_data.get("cull_joints", False))
+    if select_only:
+        print("   Partitions are disjoint, exporting by selection..")
+
+    num_workers = min(len(partition_jobs), _get_max_workers(export_data))
+
+    # Single partition or single core, no benefit in spawning extra Maya processes.
+    if num_workers <= 1:
+        # Writes the buffered logs even if an export error is raised.
         try:
-            preset_path = export_data.get("preset_path", None)
-            up_axis = export_data.get("up_axis", None)
-            fbx_version = export_data.get("fbx_version", None)
-            file_type = export_data.get("file_type", "binary").lower()
-            # export settings config
-            pfbx.FBXResetExport()
-            # set configuration
-            if preset_path is not None:
-                # load FBX export preset file
-                pfbx.FBXLoadExportPresetFile(f=preset_path)
-            fbx_version_str = None
-            if up_axis is not None:
-                pfbx.FBXExportUpAxis(up_axis.lower())
-            if fbx_version is not None:
-                fbx_version_str = "{}00".format(
-                    fbx_version.split("/")[0].replace(" ", "")
-                )
-                pfbx.FBXExportFileVersion(v=fbx_version_str)
-            if file_type == "ascii":
-                pfbx.FBXExportInAscii(v=True)
+            status = _export_partitions(partition_jobs, scene_path, export_data, select_only)
+        finally:
+            _flush_log()
+    else:
+        status = _run_partition_workers(
+            partition_jobs, num_workers, scene_path, export_data, select_only)
+
+    # Moves the staged partition fbx files to their final location
+    if staging_dir is not None:
+        file_name = export_data.get("file_name", "")
+        for partition_name, _, _ in partition_jobs:
+            partition_file_name = file_name + "_" + partition_name + ".fbx"
+            staged_path = os.path.join(staging_dir, partition_file_name)
+            if os.path.exists(staged_path):
+                shutil.move(staged_path, os.path.join(file_path, partition_file_name))
 
-            cmds.select(clear=True)
-            cmds.select(partition_joints + partition_meshes)
-            pfbx.FBXExport(f=export_path, s=True)
-        except Exception:
-            cmds.error(
-                "Something wrong happened while export Partition {}: {}".format(
-                    partition_name,
-                    traceback.format_exc()
-                )
+    return status
+
+
+def _get_tmp_root():
+    """
+    Gets the directory that intermediate files are written to.
+
+    Uses the MGEAR_FBX_TMP environment variable if it is an existing directory,
+    otherwise the in memory /dev/shm file system when available, and the system
+    temp directory last.
+
+    :rtype: str
+    """
+    tmp_root = os.environ.get("MGEAR_FBX_TMP")
+    if tmp_root:
+        if os.path.isdir(tmp_root):
+            return tmp_root
+        print("   [Warning] MGEAR_FBX_TMP is not a directory: {}".format(tmp_root))
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+def _get_max_workers(export_data):
+    """
+    Gets the maximum number of mayapy worker processes.
+
+    Each worker is a full Maya session holding the whole rig, so the count can be
+    limited with the "max_workers" export data entry, or the MGEAR_FBX_MAX_WORKERS
+    environment variable. Defaults to the number of cpus.
+
+    :param dict export_data: export configuration.
+    :rtype: int
+    """
+    max_workers = export_data.get("max_workers", None)
+    if max_workers is None:
+        max_workers = os.environ.get("MGEAR_FBX_MAX_WORKERS", None)
+    if max_workers is None:
+        return os.cpu_count() or 1
+
+    try:
+        return max(int(max_workers), 1)
+    except ValueError:
+        print("   [Warning] Invalid max workers: {}".format(max_workers))
+        return os.cpu_count() or 1
+
+
+def _is_disjoint_scene_cover(partition_jobs, cull_joints):
+    """
+    Checks if the partitions do not share any objects, and together contain all
+    the mesh (and joint, when culling joints) objects in the current scene.
+
+    As the FBX export includes the children of the selected objects, the check
+    also fails if a kept object of one partition is a descendant of an object
+    selected by another partition.
+
+    Note: When culling joints, every partition hierarchy starts at the root joint,
+    so partitions always share it and this only passes for a single partition.
+
+    :param list partition_jobs: (partition name, partition data, partition meshes) tuples.
+    :param bool cull_joints: if joints are removed from the partitions.
+    :rtype: bool
+    """
+    union = set()
+    for _, partition_data, partition_meshes in partition_jobs:
+        keep_set = _get_partition_keep_set(partition_data, partition_meshes, cull_joints)
+        if not union.isdisjoint(keep_set):
+            return False
+        union.update(keep_set)
+
+    mesh_objects, joint_objects = _get_all_mesh_and_joint_dag_objects()
+    scene_objects = set(mesh_objects)
+    if cull_joints:
+        scene_objects.update(joint_objects)
+
+    if union != scene_objects:
+        return False
+
+    # Maps the objects each partition selects on export, to the partition indices.
+    selected_by = dict()
+    for index, (_, partition_data, partition_meshes) in enumerate(partition_jobs):
+        for path in list(partition_meshes) + partition_data.get("hierarchy", []):
+            selected_by.setdefault(path, set()).add(index)
+
+    for index, (_, partition_data, partition_meshes) in enumerate(partition_jobs):
+        keep_set = _get_partition_keep_set(partition_data, partition_meshes, cull_joints)
+        for keep_path in keep_set:
+            split_path = keep_path.split("|")
+            for i in range(2, len(split_path)):
+                ancestor = "|".join(split_path[:i])
+                if selected_by.get(ancestor, set()) - {index}:
+                    return False
+
+    return True
+
+
+def _get_partition_keep_set(partition_data, partition_meshes, cull_joints):
+    """
+    Gets the full path names of the objects that a partition keeps.
+
+    :param dict partition_data: correlated partition data, containing the "hierarchy".
+    :param list partition_meshes: meshes that belong to the partition.
+    :param bool cull_joints: if joints are removed from the partitions.
+    :rtype: set[str]
+    """
+    keep_set = set(partition_meshes)
+    if cull_joints:
+        keep_set.update(partition_data.get("hierarchy", []))
+    return keep_set
+
+
+def _run_partition_workers(partition_jobs, num_workers, scene_path, export_data, select_only=False):
+    """
+    Splits the partition jobs across multiple mayapy processes, that each load
+    the conditioned scene and export their share of the partitions.
+
+    Maya commands cannot be run in parallel inside a single process, so each
+    worker is a separate mayapy instance.
+
+    :param list partition_jobs: (partition name, partition data, partition meshes) tuples.
+    :param int num_workers: number of mayapy processes to launch.
+    :param str scene_path: path to the conditioned .ma file.
+    :param dict export_data: export configuration.
+    :param bool select_only: export the partitions by selection, without deleting objects.
+    :return: True if all workers exported successfully.
+    :rtype: bool
+    """
+    mayapy_path = os.path.join(coreUtils.get_maya_path(), "mayapy")
+
+    # Makes sure the worker processes can import mgear.
+    scripts_dir = os.path.dirname(os.path.dirname(os.path.abspath(mgear.__file__)))
+    env = os.environ.copy()
+    env["PYTHONPATH"] = os.pathsep.join(
+        [scripts_dir] + [p for p in [env.get("PYTHONPATH")] if p])
+
+    workers = []
+    job_paths = []
+    try:
+        for worker_index in range(num_workers):
+            # Round robin the partitions, so each worker gets a similar amount of work
+            chunk = partition_jobs[worker_index::num_workers]
+
+            with tempfile.NamedTemporaryFile(mode="w", delete=False, suffix=".json") as job_file:
+                job_paths.append(job_file.name)
+                json.dump(
+                    {
+                        "scene_path": scene_path,
+                        "export_data": export_data,
+                        "partitions": chunk,
+                        "select_only": select_only,
+                    },
+                    job_file)
+
+            # Maya standalone is uninitialized before exiting, as mayapy can crash
+            # during interpreter shutdown otherwise, reporting a failed export.
+            worker_script = "\n".join([
+                "import sys",
+                "import maya.standalone",
+                "maya.standalone.initialize(name='python')",
+                "try:",
+                "    from mgear.shifter.game_tools_fbx import fbx_batch",
+                "    status = fbx_batch._export_partition_job({!r})",
+                "finally:",
+                "    maya.standalone.uninitialize()",
+                "sys.exit(0 if status else 1)",
+            ]).format(job_file.name)
+
+            print("   [Worker {}] Partitions: {}".format(
+                worker_index, [job[0] for job in chunk]))
+            process = subprocess.Popen([mayapy_path, "-c", worker_script], env=env)
+            workers.append((process, job_file.name))
+    except Exception:
+        # Stops the workers that already started, before the work directory
+        # they are reading from is removed.
+        print("   [Worker Launch Failed] {}".format(traceback.format_exc()))
+        for process, _ in workers:
+            process.terminate()
+            process.wait()
+        for job_path in job_paths:
+            if os.path.exists(job_path):
+                os.remove(job_path)
+        return False
+
+    status = True
+    for process, job_path in workers:
+        returncode = process.wait()
+        if returncode != 0:
+            print("   [Worker Failed] Return Code: {}".format(returncode))
+            status = False
+        if os.path.exists(job_path):
+            os.remove(job_path)
+
+    return status
+
+
+def _export_partition_job(job_path):
+    """
+    Entry point for the mayapy worker processes.
+
+    Reads the job file written by _run_partition_workers, and exports each
+    partition it contains.
+
+    :param str job_path: path to the json job file.
+    :return: True if all the partitions exported successfully.
+    :rtype: bool
+    """
+    with open(job_path, "r") as f:
+        job = json.load(f)
+
+    try:
+        return _export_partitions(
+            job["partitions"], job["scene_path"], job["export_data"], job.get("select_only", False))
+    finally:
+        _flush_log()
+
+
+def _export_partitions(partition_jobs, scene_path, export_data, select_only=False):
+    """
+    Exports each of the partition jobs.
+
+    The conditioned .ma file is only loaded when the scene that was trimmed by
+    the previous partition no longer contains everything the next partition
+    needs, otherwise the trimmed scene is reused.
+
+    :param list partition_jobs: (partition name, partition data, partition meshes) tuples.
+    :param str scene_path: path to the conditioned .ma file.
+    :param dict export_data: export configuration.
+    :param bool select_only: export the partitions by selection, without deleting
+        objects, so the scene only needs to be loaded once.
+    :return: True if all the partitions exported successfully.
+    :rtype: bool
+    """
+    cull_joints = export_data.get("cull_joints", False)
+
+    # The export settings are the same for every partition.
+    try:
+        _apply_fbx_export_settings(export_data)
+    except Exception:
+        cmds.error(
+            "Something wrong happened while applying the export settings: {}".format(
+                traceback.format_exc()
             )
+        )
+        return False
+
+    # Mesh and joint full paths, of the scene as it was loaded and as it currently is.
+    master_inventory = None
+    scene_inventory = None
+
+    for partition_name, partition_data, partition_meshes in partition_jobs:
+        keep_set = _get_partition_keep_set(partition_data, partition_meshes, cull_joints)
+
+        # The trimmed scene is only reused if it still has every kept object. The
+        # inventory check is backed by a lookup in the scene, in case the deletes
+        # removed more than the queued nodes.
+        reuse_scene = (
+            scene_inventory is not None
+            and (keep_set & master_inventory) <= scene_inventory
+            and _objects_exist(keep_set & master_inventory)
+        )
+
+        if not reuse_scene:
+            _log("Open Conditioned Scene: {}".format(scene_path))
+            # Loads the conditioned scene file, to perform partition actions on.
+            cmds.file(scene_path, open=True, force=True, save=False)
+            if master_inventory is None:
+                master_inventory = _get_dag_inventory()
+            scene_inventory = master_inventory
+        else:
+            _log("Reusing Trimmed Scene: {}".format(scene_path))
+
+        if not select_only:
+            deleted_paths = _trim_partition(
+                partition_meshes, partition_data.get("hierarchy", []), cull_joints)
+            scene_inventory = _remove_deleted_from_inventory(scene_inventory, deleted_paths)
+
+        exported = _export_one_partition(
+            partition_name, partition_data, partition_meshes, export_data)
+        _flush_log()
+        if not exported:
             return False
+
+    return True
+
+
+def _get_dag_inventory():
+    """
+    Gets the full path names of all the mesh and joint dag objects in the scene.
+
+    :rtype: set[str]
+    """
+    mesh_objects, joint_objects = _get_all_mesh_and_joint_dag_objects()
+    return set(mesh_objects) | set(joint_objects)
+
+
+def _objects_exist(paths):
+    """
+    Checks that all the objects exist in the scene.
+
+    :param set paths: full path names.
+    :rtype: bool
+    """
+    for path in paths:
+        temp_sel = om.MSelectionList()
+        try:
+            temp_sel.add(path)
+        except RuntimeError:
+            return False
+    return True
+
+
+def _remove_deleted_from_inventory(inventory, deleted_paths):
+    """
+    Removes the deleted objects, and their descendants, from the inventory.
+
+    Note: This is only valid when the deletes remove exactly the deleted objects
+    and their descendants, which is why _trim_partition does not include parents.
+
+    :param set inventory: mesh and joint full path names.
+    :param list[str] deleted_paths: full path names of the deleted objects.
+    :return: the remaining inventory.
+    :rtype: set[str]
+    """
+    deleted_set = set(deleted_paths)
+    remaining = set()
+    for path in inventory:
+        split_path = path.split("|")
+        if not any("|".join(split_path[:i]) in deleted_set for i in range(2, len(split_path) + 1)):
+            remaining.add(path)
+    return remaining
+
+
+def _trim_partition(partition_meshes, partition_joints, cull_joints):
+    """
+    Deletes the meshes, and joints when culling joints, that are not included
+    in the partition.
+
+    :param list partition_meshes: meshes that belong to the partition.
+    :param list partition_joints: joints that belong to the partition.
+    :param bool cull_joints: if joints are removed from the partitions.
+    :return: full path names of the deleted objects.
+    :rtype: list[str]
+    """
+    partition_mesh_set = set(partition_meshes)
+    partition_joint_set = None
+    if cull_joints:
+        _log("    Culling Joints...")
+        partition_joint_set = set(partition_joints)
+
+    garbage = _collect_dag_garbage(partition_mesh_set, partition_joint_set)
+    deleted_paths = [dag_path.fullPathName() for dag_path in garbage]
+
+    # All the deletes are flushed at once by a single modifier. Parents are not
+    # included, so transforms left without children are kept, like cmds.delete.
+    dag_mod = om.MDagModifier()
+    for dag_path in garbage:
+        dag_mod.deleteNode(dag_path.node(), False)
+    dag_mod.doIt()
+
+    return deleted_paths
+
+
+def _export_one_partition(partition_name, partition_data, partition_meshes, export_data):
+    """
+    Exports a single partition by selection, from the currently loaded conditioned scene.
+
+    :param str partition_name: name of the partition.
+    :param dict partition_data: correlated partition data, containing the "hierarchy".
+    :param list partition_meshes: meshes that belong to the partition.
+    :param dict export_data: export configuration.
+    :return: True if the partition was exported.
+    :rtype: bool
+    """
+    file_path = export_data.get("file_path", "")
+    file_name = export_data.get("file_name", "")
+
+    partition_joints = partition_data.get("hierarchy", [])
+
+    # Exporting fbx
+    partition_file_name = file_name + "_" + partition_name + ".fbx"
+    export_path = os.path.join(file_path, partition_file_name)
+
+    _log("Exporting FBX: {}".format(export_path))
+    try:
+        cmds.select(clear=True)
+        cmds.select(partition_joints + partition_meshes)
+        pfbx.FBXExport(f=export_path, s=True)
+    except Exception:
+        cmds.error(
+            "Something wrong happened while export Partition {}: {}".format(
+                partition_name,
+                traceback.format_exc()
+            )
+        )
+        return False
     return True
 
 
+def _apply_fbx_export_settings(export_data):
+    """
+    Resets the FBX export settings, and applies the export configuration.
+
+    The settings are not affected by loading a scene, so this only needs to be
+    performed once before exporting the partitions.
+
+    :param dict export_data: export configuration.
+    """
+    preset_path = export_data.get("preset_path", None)
+    up_axis = export_data.get("up_axis", None)
+    fbx_version = export_data.get("fbx_version", None)
+    file_type = export_data.get("file_type", "binary").lower()
+    # export settings config
+    pfbx.FBXResetExport()
+    # set configuration
+    if preset_path is not None:
+        # load FBX export preset file
+        pfbx.FBXLoadExportPresetFile(f=preset_path)
+    fbx_version_str = None
+    if up_axis is not None:
+        pfbx.FBXExportUpAxis(up_axis.lower())
+    if fbx_version is not None:
+        fbx_version_str = "{}00".format(
+            fbx_version.split("/")[0].replace(" ", "")
+        )
+        pfbx.FBXExportFileVersion(v=fbx_version_str)
+    if file_type == "ascii":
+        pfbx.FBXExportInAscii(v=True)
+
+
+def _collect_dag_garbage(keep_mesh_set, keep_joint_set=None):
+    """
+    Finds all the mesh and joint DAG objects that are not part of the keep sets,
+    in a single DAG traversal.
+
+    Objects that are ancestors of a kept object are never collected, and once an
+    object is collected its children are skipped, as they will be deleted with it.
+
+    :param set keep_mesh_set: full path names of the meshes to keep.
+    :param set keep_joint_set: full path names of the joints to keep, if None
+        joints are not collected.
+    :return: dag paths to delete, deepest objects first.
+    :rtype: list[om.MDagPath]
+    """
+    # All the ancestors of the kept objects, need to be kept as well.
+    keep_ancestors = set()
+    for keep_path in keep_mesh_set | (keep_joint_set or set()):
+        split_path = keep_path.split("|")
+        for i in range(2, len(split_path)):
+            keep_ancestors.add("|".join(split_path[:i]))
+
+    to_delete = []
+
+    dag_iter = om.MItDag(om.MItDag.kDepthFirst)
+
+    while not dag_iter.isDone():
+        current_dag_path = dag_iter.getPath()
+
+        if current_dag_path.hasFn(om.MFn.kTransform):
+            full_path = current_dag_path.fullPathName()
+
+            if current_dag_path.hasFn(om.MFn.kMesh):
+                keep = full_path in keep_mesh_set
+            elif keep_joint_set is not None and current_dag_path.hasFn(om.MFn.kJoint):
+                keep = full_path in keep_joint_set
+            else:
+                keep = True
+
+            if not keep and full_path not in keep_ancestors:
+                to_delete.append(current_dag_path)
+                # Children are deleted with the parent
+                dag_iter.prune()
+
+        dag_iter.next()
+
+    # Deepest objects first, so children are deleted before their parents.
+    to_delete.sort(key=lambda dag_path: dag_path.fullPathName().count("|"), reverse=True)
+
+    return to_delete
+
+
 def _delete_blendshapes():
     """
     Deletes all blendshape objects in the scene.
@@ -332,6 +858,11 @@ def _delete_blendshapes():
 
 
 def _find_geometry_dag_objects(parent_object_name):
+    """
+    Gets the full path names of all the geometry dag objects under the parent object.
+
+    Only returns DAG object and not the shape node.
+    """
     selection_list = om.MSelectionList()
 
     try:
@@ -339,25 +870,26 @@ def _find_geometry_dag_objects(parent_object_name):
         selection_list.add(parent_object_name)
 
         # Get the MDagPath of the parent object
-        parent_dag_path = om.MDagPath()
         parent_dag_path = selection_list.getDagPath(0)
 
-        # Iterate through child objects
-        child_count = parent_dag_path.childCount()
+        # Iterate through all the objects under the parent
+        dag_iter = om.MItDag()
+        dag_iter.reset(parent_dag_path, om.MItDag.kDepthFirst, om.MFn.kInvalid)
+
+        # The parent object is not part of the results
+        dag_iter.next()
+
         geometry_objects = []
 
-        for i in range(child_count):
-            child_obj = parent_dag_path.child(i)
-            child_dag_node = om.MFnDagNode(child_obj)
-            child_dag_path = child_dag_node.getPath()
+        while not dag_iter.isDone():
+            child_dag_path = dag_iter.getPath()
 
             # Check if the child is a geometry node
             if (child_dag_path.hasFn(om.MFn.kMesh) or child_dag_path.hasFn(
                     om.MFn.kNurbsSurface)) and child_dag_path.hasFn(om.MFn.kTransform):
                 geometry_objects.append(child_dag_path.fullPathName())
 
-            # Recursive call to find geometry objects under the child
-            geometry_objects.extend(_find_geometry_dag_objects(child_dag_path.fullPathName()))
+            dag_iter.next()
 
         return geometry_objects
 
@@ -385,21 +917,16 @@ def _find_dg_nodes_by_type(node_type):
     """
     returns a list of MObjects, that match the node type
     """
-    dagpose_nodes = []
+    found_nodes = []
 
-    # Create an iterator to traverse all dependency nodes
-    dep_iter = om.MItDependencyNodes()
+    # Create an iterator that only traverses the dependency nodes of the node type
+    dep_iter = om.MItDependencyNodes(node_type)
 
     while not dep_iter.isDone():
-        current_node = dep_iter.thisNode()
-
-        # Check if the node is a DAG Pose node
-        if current_node.hasFn(node_type):
-            dagpose_nodes.append(current_node)
-
+        found_nodes.append(dep_iter.thisNode())
         dep_iter.next()
 
-    return dagpose_nodes
+    return found_nodes
 
 
 def _cleanup_stale_dag_hierarchies(ignore_objects):
@@ -407,22 +934,34 @@ def _cleanup_stale_dag_hierarchies(ignore_objects):
     Deletes any dag objects that are not geo or skeleton roots, under the scene root.
     """
     IGNORED_OBJECTS = ['|persp', '|top', '|front', '|side']
-    obj_names = _get_dag_objects_under_scene_root()
+    root_objects = _get_dag_mobjects_under_scene_root()
 
-    for i_o in IGNORED_OBJECTS:
-        obj_names.remove(i_o)
-
-    for i_o in ignore_objects:
-        pipped_io = "|" + i_o
-        try:
-            obj_names.remove(pipped_io)
-        except:
-            print("  skipped {}".format(pipped_io))
+    stale_names = root_objects.keys() - set(IGNORED_OBJECTS)
+    stale_names -= {"|" + i_o for i_o in ignore_objects}
 
     # Delete left over object hierarchies
     dag_mod = om.MDagModifier()
 
-    for name in obj_names:
+    for name in stale_names:
+        dag_mod.deleteNode(root_objects[name])
+
+    dag_mod.doIt()
+
+
+def _parent_to_root(names):
+    """
+    Moves the objects to the scene root, keeping their world space transform.
+
+    Objects that are already under the world are skipped. All the objects are
+    reparented by a single MDagModifier, which keeps the local transform values,
+    so the world matrix of each object is restored after the reparent.
+
+    :param list[str] names: names of the objects to move to the scene root.
+    """
+    dag_mod = om.MDagModifier()
+    moved = []
+
+    for name in names:
         temp_sel = om.MSelectionList()
         temp_sel.add(name)
 
@@ -430,54 +969,64 @@ def _cleanup_stale_dag_hierarchies(ignore_objects):
             continue
 
         dag_path = temp_sel.getDagPath(0)
-        dag_node = om.MFnDagNode(dag_path)
-        dag_mod.deleteNode(dag_node.object())
-        dag_mod.doIt()
 
+        # Already under the world
+        if dag_path.length() == 1:
+            continue
 
-def _parent_to_root(name):
-    """
-    As Maya's parent command can cause failures if you try and parent the object to 
-    the same object it is already parented to. We check the parent, and only if it
-    it not the world do we reparent the object.
-    """
-    temp_sel = om.MSelectionList()
-    temp_sel.add(name)
+        mobj = dag_path.node()
+        dag_mod.reparentNode(mobj, om.MObject.kNullObj)
+        moved.append((name, mobj, dag_path.inclusiveMatrix()))
 
-    if temp_sel.length() != 1:
+    if not moved:
         return
 
-    dag_path = temp_sel.getDagPath(0)
-    dag_node = om.MFnDagNode(dag_path)
-    parent_obj = dag_node.parent(0)
-    parent_name = om.MFnDependencyNode(parent_obj).name()
+    dag_mod.doIt()
 
-    if parent_name == "world":
-        return
+    for name, mobj, world_matrix in moved:
+        transform_matrix = om.MTransformationMatrix(world_matrix)
+        transform_fn = om.MFnTransform(mobj)
+        transform_fn.setTransformation(transform_matrix)
 
-    cmds.parent(name, world=True)
+        # Joints apply their orientation after the rotation, so it is removed
+        # from the world rotation.
+        if mobj.hasFn(om.MFn.kJoint):
+            orientation = oma.MFnIkJoint(mobj).orientation()
+            rotation = transform_matrix.rotation(asQuaternion=True) * orientation.inverse()
+            transform_fn.setRotation(rotation, om.MSpace.kTransform)
 
-    temp_sel.clear()
-    print("  Moved {} to scene root.".format(name))
+        print("  Moved {} to scene root.".format(name))
 
 
 def _get_dag_objects_under_scene_root():
     """
     Gets a list of all dag objects that direct children of the scene root.
     """
+    return list(_get_dag_mobjects_under_scene_root())
+
+
+def _get_dag_mobjects_under_scene_root():
+    """
+    Gets the dag objects that are direct children of the scene root.
+
+    :return: full path names mapped to their MObject.
+    :rtype: dict[str, om.MObject]
+    """
     # Create an MItDag iterator starting from the root of the scene
-    dag_iter = om.MItDag(om.MItDag.kDepthFirst, om.MFn.kInvalid)
+    dag_iter = om.MItDag(om.MItDag.kBreadthFirst)
 
-    dag_objects = []
+    dag_objects = OrderedDict()
 
     while not dag_iter.isDone():
-        current_dag_path = dag_iter.getPath()
+        depth = dag_iter.depth()
 
-        # Check if the current DAG path is under the scene root
-        if current_dag_path.length() == 1:
-            dag_objects.append(current_dag_path.fullPathName())
+        # Breadth first, so once past the scene root children there is nothing left to check.
+        if depth > 1:
+            break
+
+        if depth == 1:
+            dag_objects[dag_iter.fullPathName()] = dag_iter.currentItem()
 
-        # Move to the next DAG object
         dag_iter.next()
 
     return dag_objects
@@ -486,8 +1035,7 @@ def _get_dag_objects_under_scene_root():
 def _clean_namespaces(export_data):
     """
     Gets all available namespaces in scene.
-    Checks each for objects that have it assigned.
-    Removes the namespace from the object.
+    Removes each namespace, merging its objects into the root namespace.
     """
     namespaces = _get_scene_namespaces()
 
@@ -495,17 +1043,9 @@ def _clean_namespaces(export_data):
     namespaces = sorted(namespaces, key=_count_namespaces, reverse=True)
 
     for namespace in namespaces:
-        print("  - {}".format(namespace))
-        child_namespaces = om.MNamespace.getNamespaces(namespace, True)
-
-        for chld_ns in child_namespaces:
-            m_objs = om.MNamespace.getNamespaceObjects(chld_ns)
-            for m_obj in m_objs:
-                _remove_namespace(m_obj)
-
-        m_objs = om.MNamespace.getNamespaceObjects(namespace)
-        for m_obj in m_objs:
-            _remove_namespace(m_obj)
+        _log("  - {}".format(namespace))
+        cmds.namespace(removeNamespace=namespace, mergeNamespaceWithRoot=True)
+    _flush_log()
 
     filtered_export_data = _clean_export_namespaces(export_data)
     return filtered_export_data
@@ -551,15 +1091,6 @@ def _trim_namespace_from_name(name):
     name = "|".join(split_long_name)
     return name
 
-def _remove_namespace(mobj):
-    """
-    Removes the namesspace that is currently assigned to the asset
-    """
-    dg = om.MFnDependencyNode(mobj)
-    name = dg.name()
-    dg.setName(name[len(dg.namespace):])
-
-
 def _get_scene_namespaces():
     """
     Gets all namespaces in the scene.
@@ -603,8 +1134,8 @@ def _get_joint_list(start_joint, end_joint):
     # Tries to convert the start_joint into the full path
     try:
         sel_list.add(start_joint)
-        dag_path = sel_list.getDagPath(0)
-        full_path = dag_path.fullPathName()
+        start_dag_path = sel_list.getDagPath(0)
+        full_path = start_dag_path.fullPathName()
         if start_joint != full_path:
             start_joint = full_path
         sel_list.clear()
@@ -615,8 +1146,8 @@ def _get_joint_list(start_joint, end_joint):
     # Tries to convert the end_joint into the full path
     try:
         sel_list.add(end_joint)
-        dag_path = sel_list.getDagPath(0)
-        full_end_joint = dag_path.fullPathName()
+        end_dag_path = sel_list.getDagPath(0)
+        full_end_joint = end_dag_path.fullPathName()
         if end_joint != full_end_joint:
             end_joint = full_end_joint
     except:
@@ -627,92 +1158,134 @@ def _get_joint_list(start_joint, end_joint):
         return [start_joint]
 
     # check hierarchy
-    descendant_list = cmds.ls(
-        cmds.listRelatives(start_joint, ad=True, fullPath=True),
-        long=True,
-        type="joint",
-    )
+    dag_iter = om.MItDag()
+    dag_iter.reset(start_dag_path, om.MItDag.kDepthFirst, om.MFn.kJoint)
+    descendants = set()
+    while not dag_iter.isDone():
+        descendants.add(dag_iter.fullPathName())
+        dag_iter.next()
 
     # if the end joint does not exist in the hierarch as the start joint, return
-    if not descendant_list.count(end_joint):
+    if end_joint not in descendants:
         return list()
 
     joint_list = [end_joint]
 
+    # Walks up the dag path, one parent at a time
+    parent_dag_path = om.MDagPath(end_dag_path)
     while joint_list[-1] != start_joint:
-        parent_jnt = cmds.listRelatives(joint_list[-1], p=True, pa=True, fullPath=True)
-        if not parent_jnt:
+        parent_dag_path.pop()
+        if parent_dag_path.length() == 0:
             raise Exception(
                 'Found root joint while searching for start joint "{}"'.format(
                     start_joint
                 )
             )
-        joint_list.append(parent_jnt[0])
+        joint_list.append(parent_dag_path.fullPathName())
 
     joint_list.reverse()
 
     return joint_list
 
 
-def _get_root_joint(start_joint):
-    """
-    Recursively traverses up the hierarchy until finding the first object that does not have a parent.
+def _get_cached_joint_list(start_joint, end_joint, ancestor_cache):
+    """Returns a list of joints between and including given start and end joint,
+    reusing the paths that have already been resolved from the start joint.
 
-    :param str node_name: node name to get root of.
-    :param str node_type: node type for the root node.
-    :return: found root node.
-    :rtype: str
+    Joints that share ancestors with a previously resolved joint only walk up
+    until they reach a cached ancestor.
+
+    Args:
+            start_joint str: start joint of joint list
+            end_joint str: end joint of joint list
+            ancestor_cache dict: maps a joint full path to its [start, ..., joint]
+                list, must only be used with the same start joint.
+
+    Returns:
+            list[str]: joint list
     """
+    sel_list = om.MSelectionList()
+    try:
+        sel_list.add(start_joint)
+        sel_list.add(end_joint)
+        start_joint = sel_list.getDagPath(0).fullPathName()
+        end_dag_path = sel_list.getDagPath(1)
+    except:
+        # Falls back to the uncached lookup, which reports the missing joint
+        return _get_joint_list(start_joint, end_joint)
 
-    parent = cmds.listRelatives(start_joint, parent=True, type="joint")
-    parent = parent[0] if parent else None
+    end_joint = end_dag_path.fullPathName()
 
-    return _get_root_joint(parent) if parent else start_joint
+    if start_joint == end_joint:
+        return [start_joint]
 
+    # The end joint needs to be a joint, under the start joint. This is checked
+    # before the cache, as the cache also holds the non joint transforms walked through.
+    if not end_dag_path.hasFn(om.MFn.kJoint) or not end_joint.startswith(start_joint + "|"):
+        return list()
 
-def _get_all_mesh_dag_objects():
-    """
-    Gets all mesh dag objects in scene.
+    if end_joint in ancestor_cache:
+        return list(ancestor_cache[end_joint])
 
-    Only returns DAG object and not the shape node.
+    # Walks up the full path, until reaching the start joint or a cached ancestor.
+    uncached = []
+    current = end_joint
+    while current != start_joint and current not in ancestor_cache:
+        uncached.append(current)
+        current = current.rsplit("|", 1)[0]
 
-    returns list of full path names
-    """
-    mesh_objects = []
+    joint_list = ancestor_cache.get(current, [start_joint])
+    for jnt in reversed(uncached):
+        joint_list = joint_list + [jnt]
+        ancestor_cache[jnt] = joint_list
 
-    dag_iter = om.MItDag(om.MItDag.kBreadthFirst)
+    return list(joint_list)
 
-    while not dag_iter.isDone():
-        current_dag_path = dag_iter.getPath()
 
-        # Check if the current object has a mesh function set
-        if current_dag_path.hasFn(om.MFn.kMesh):
-            if current_dag_path.hasFn(om.MFn.kTransform):
-                mesh_objects.append(current_dag_path.fullPathName())
+def _get_root_joint(start_joint):
+    """
+    Traverses up the hierarchy until finding the first joint that does not have a joint parent.
 
-        dag_iter.next()
+    :param str start_joint: joint name to get root of.
+    :return: found root joint full path name.
+    :rtype: str
+    """
+    sel_list = om.MSelectionList()
+    sel_list.add(start_joint)
+    dag_node = om.MFnDagNode(sel_list.getDagPath(0))
+
+    while dag_node.parentCount():
+        parent_obj = dag_node.parent(0)
+        if not parent_obj.hasFn(om.MFn.kJoint):
+            break
+        dag_node.setObject(parent_obj)
 
-    return mesh_objects
+    return dag_node.fullPathName()
 
 
-def _get_all_joint_dag_objects():
+def _get_all_mesh_and_joint_dag_objects():
     """
-    Gets all mesh dag objects in scene.
+    Gets all mesh and joint dag objects in scene, in a single DAG traversal.
 
     Only returns DAG object and not the shape node.
+
+    returns a tuple of the mesh and joint full path names lists
     """
     mesh_objects = []
+    joint_objects = []
 
     dag_iter = om.MItDag(om.MItDag.kBreadthFirst)
 
     while not dag_iter.isDone():
         current_dag_path = dag_iter.getPath()
 
-        # Check if the current object has a mesh function set
-        if current_dag_path.hasFn(om.MFn.kJoint):
-            if current_dag_path.hasFn(om.MFn.kTransform):
+        if current_dag_path.hasFn(om.MFn.kTransform):
+            # Check if the current object has a mesh or joint function set
+            if current_dag_path.hasFn(om.MFn.kMesh):
                 mesh_objects.append(current_dag_path.fullPathName())
+            if current_dag_path.hasFn(om.MFn.kJoint):
+                joint_objects.append(current_dag_path.fullPathName())
 
         dag_iter.next()
 
-    return mesh_objects
+    return mesh_objects, joint_objects